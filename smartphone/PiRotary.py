@@ -4,6 +4,20 @@ import time
 import pigpio
 import subprocess
 import json
+import os
+import queue
+import threading
+import signal
+import sys
+from dataclasses import dataclass
+
+# Faster json parser if available, otherwise the standard library one.
+# Both accept the raw bytes of the file.
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 PI_HIGH = 1
 PI_LOW = 0
@@ -23,40 +37,87 @@ pin_phone_hangout = 23      # Phone hangup/hangout input (pin 16)
 pin_dialer_led = 24         # Dialer counter LED (pin 19)
 pin_dial_counter_led = 25   # On when the dialer is ready (pin 22)
 
+# Bank 1 bit masks of the amplifier buttons, used to build the buttons waveform
+_AMPLI_POWER_MASK = 1 << pin_ampli_power
+_AMPLI_MODE_MASK = 1 << pin_ampli_mode
+
+# Bank 1 bit mask of all the LEDs
+_LED_MASK = (1 << pin_dial_counter_led) | (1 << pin_hangout_led) | (1 << pin_dialer_led)
+
 # ------------------------------------------------------------------------------
 # Global variables, flags and counters
 # ------------------------------------------------------------------------------
-cb_hangout_handler = 0      # Callback handler for the hangout switch
-cb_dialer_handler = 0       # Callback handler for the rotary dialer
-cb_counter_handler = 0      # Callback handler for the rotary pulse counter
+cb_handlers = []            # Callback handlers of the hangout and rotary pins
+
+# Callback function of every pin, called by _gpio_dispatch(). The table is
+# replaced as a whole to enable or disable the callbacks.
+_gpio_handlers = {}
+
+# Waveform id of the amplifier buttons sequence, created by initGPIO()
+_ampli_wave = None
+
+# Persistent text-to-speech process, started by initGPIO()
+_tts_proc = None
+
+# Commands queued by the callbacks and executed one at a time, in order, by
+# the worker thread. Every entry is a (function, argument) tuple.
+_cmd_q = queue.Queue()
 
 # Status of the amplifier, or at least what it is expected to be. If the amplifier
 # status is not corresponding there is a number to dial to reset the status
 # accordingly with the pick-up switch detector.
 ampli_status = False    # Become true when the amplifier is during a powering On/Off state
 
-# Initially set to false it is True when the user start dialing a number with the
-# rotary dialer. The status remain True until the rotary dialer has not completed the
-# counterclockwise rotation emitting all the impulses corresponding to the dialled
-# number.
-dialer_status = False   # Become true when the user start dialing a number
+# Glitch filters (microseconds) of the rotary dialer inputs. A level change must
+# be steady for this time to be notified, so contact bounces are dropped by the
+# pigpio daemon before reaching the callbacks.
+dial_counter_glitch = 1000
+dial_detect_glitch = 5000
+
+# Glitch filter (microseconds) of the pick-up switch
+phone_hangout_glitch = 50000
+
+# Last status of the pick-up switch processed by pickup_switch(). The phone
+# is hung up when the application starts.
+hangout_status = PI_LOW
 
-# Pulse counter of the rotary dialer. WHen the dialer_status is high the
-# counter is incrememnted while, when the dialer_status goes low the dialed
-# number sequence is updated with the last number dialed.
-pulses = 0
 
-# Compound dialed number in string format. Until a number is not recognized as a command
-# the further dialed numbers are queued to the string. It the number of characters of the
-# dialed number reach the max lenght and has no meaning the number is reset and the counter
-# restart to a new number.
-dialed_number = ''
+@dataclass
+class DialerState:
+    '''
+    Status of the rotary dialer, shared by the dialer callbacks
+    '''
+
+    # Initially set to low it is high when the user start dialing a number with the
+    # rotary dialer. The status remain high until the rotary dialer has not completed the
+    # counterclockwise rotation emitting all the impulses corresponding to the dialled
+    # number.
+    dialer_status: int = PI_LOW
+
+    # Pulse counter of the rotary dialer. WHen the dialer_status is high the
+    # counter is incrememnted while, when the dialer_status goes low the dialed
+    # number sequence is updated with the last number dialed.
+    pulses: int = 0
+
+    # Compound dialed number in string format. Until a number is not recognized as a command
+    # the further dialed numbers are queued to the string. It the number of characters of the
+    # dialed number reach the max lenght and has no meaning the number is reset and the counter
+    # restart to a new number.
+    dialed_number: str = ''
+
+
+# Rotary dialer status instance
+_state = DialerState()
 
 # Maximum number of characters of the dialed number.
 # This depends on the numeric commands structures decided by the program. A three-number
 # command code is sufficient for 999 different commands, maybe sufficient!
 max_numbers = 3
 
+# Dial code restarting the application to initial conditions. The dialed number
+# is reset by the dialer callback as soon as the code is complete.
+reset_number = '666'
+
 DEBUG = False            # Set to False to remove the debug terminal output
 
 # PiGPIO library instance, globally defined
@@ -69,6 +130,19 @@ pi = pigpio.pi()
 # Parameters: -sp = speak, -n = narrator voice (not used)
 TTS = [ '/home/pi/smartphone/trans', '-sp' ]
 
+# Text-to-speech persistent shell parameters. The interactive shell reads one
+# sentence per line from stdin so the tts command is started only once.
+# Parameters: -shell = interactive shell, -no-rlwrap = plain stdin,
+# -no-ansi = plain prompt
+TTS_SHELL = [ '-shell', '-no-rlwrap', '-no-ansi' ]
+
+# Prompt written on stderr by the tts shell when it is ready for a new sentence,
+# that is when the previous one has been spoken
+TTS_PROMPT = b'> '
+
+# Full text-to-speech shell command line, built once
+_TTS_ARGV = tuple([TTS[0]] + TTS_SHELL + [TTS[1]])
+
 # Mp3 play command and parameters. Volume can be a parameter of the command but in
 # this case we only use the bare call to the player. The volume is set globally and is
 # used by default.
@@ -101,33 +175,91 @@ help_messages = ['']    # Help strings
 help_strings = 0        # Number of help strings
 tracks = 0              # Number of tracks
 music_path = ''         # mp3 files path
+track_paths = ['']      # Full mp3 file name of the tracks
 track_position = 0      # Current playing track
 is_playing = True       # Tracks playing status
 weather_airport = ''    # Airport name in human readable format
 weather_ICAO = ''       # Airport international ICAO code
 
+# Set when the json files have been loaded by _load_config()
+_config_loaded = False
 
-def initGPIO():
+# Parsed json files, keyed by path and modification time so an edited
+# file is parsed again while an unchanged one is never read twice.
+_json_cache = {}
+
+
+def _load_json(path):
     '''
-    Initialize the GPIO library and set the callback for the interested
-    pins with the corresponding function.
-    Note that the Broadcom GPIO pin 28 should not be set to a callback
-    to avoid problems.
+    Return the parsed content of the json file, reading it from the
+    SD card only the first time or when the file has been modified.
+    :param path: The json file full path
+    :return: The parsed dictionary
     '''
 
-    global pi
+    key = (path, os.stat(path).st_mtime)
+    if key not in _json_cache:
+        with open(path, 'rb') as file:
+            _json_cache[key] = json_loads(file.read())
+
+    return _json_cache[key]
+
+
+def _load_config():
+    '''
+    Load the playlist and the voice comments from the json files.
+    The files are loaded only once, the following calls do nothing
+    so reinit() and the callbacks never access the filesystem.
+    '''
+
+    global _config_loaded
     global track_list
     global track_titles
     global tracks
-    global songs
     global music_path
+    global track_paths
     global text_messages
-    global sentences_file
+    global num_messages
     global help_messages
     global help_strings
     global weather_airport
     global weather_ICAO
 
+    if _config_loaded:
+        return
+
+    # Loads the music lists
+    dictionary = _load_json(music_file)
+
+    track_list = dictionary['files']
+    track_titles = dictionary['songs']
+    tracks = int(dictionary['tracks'])
+    music_path = dictionary['folder']
+    track_paths = [music_path + track + '.mp3' for track in track_list]
+
+    # Loads the message tracks
+    dictionary = _load_json(sentences_file)
+
+    num_messages = dictionary['phrases']
+    help_strings = dictionary['helpsentences']
+    text_messages = dictionary['list']
+    help_messages = dictionary['help']
+    weather_airport = dictionary['airport']
+    weather_ICAO = dictionary['ICAO']
+
+    _config_loaded = True
+
+
+def initGPIO():
+    '''
+    Initialize the GPIO library and set the callback for the interested
+    pins with the corresponding function.
+    Note that the Broadcom GPIO pin 28 should not be set to a callback
+    to avoid problems.
+    '''
+
+    global pi
+
     # Set the output pins
     pi.set_mode(pin_hangout_led, pigpio.OUTPUT)
     pi.set_mode(pin_ampli_mode, pigpio.OUTPUT)
@@ -135,115 +267,133 @@ def initGPIO():
     pi.set_mode(pin_dialer_led, pigpio.OUTPUT)
     pi.set_mode(pin_dial_counter_led, pigpio.OUTPUT)
 
+    # Create the amplifier buttons waveform
+    create_ampli_wave()
+
     # Set the input pins
     pi.set_mode(pin_dial_counter, pigpio.INPUT)
     pi.set_pull_up_down(pin_dial_counter, pigpio.PUD_DOWN)
+    pi.set_glitch_filter(pin_dial_counter, dial_counter_glitch)
     pi.set_mode(pin_dial_detect, pigpio.INPUT)
     pi.set_pull_up_down(pin_dial_detect, pigpio.PUD_DOWN)
+    pi.set_glitch_filter(pin_dial_detect, dial_detect_glitch)
     pi.set_mode(pin_phone_hangout, pigpio.INPUT)
     pi.set_pull_up_down(pin_phone_hangout, pigpio.PUD_DOWN)
+    pi.set_glitch_filter(pin_phone_hangout, phone_hangout_glitch)
+
+    # Make sure the json files are loaded before the callbacks can fire
+    _load_config()
 
     # Set the callback for the interested pins and gets the handlers
     set_callbacks()
 
-    # Loads the music lists
-    with open(music_file) as file:
-        dictionary = json.load(file)
+    reinit()
 
-    track_list = dictionary['files']
-    track_titles = dictionary['songs']
-    tracks = int(dictionary['tracks'])
-    music_path = dictionary['folder']
+    # Start the persistent text-to-speech process
+    start_tts()
 
-    # Loads the message tracks
-    with open(sentences_file) as file:
-        dictionary = json.load(file)
+    # Start the thread executing the queued commands
+    threading.Thread(target=_worker, daemon=True).start()
 
-    num_messages = dictionary['phrases']
-    help_strings = dictionary['helpsentences']
-    text_messages = dictionary['list']
-    help_messages = dictionary['help']
-    weather_airport = dictionary['airport']
-    weather_ICAO = dictionary['ICAO']
 
-    reinit()
+def _gpio_dispatch(gpio, level, tick):
+    '''
+    Callback function shared by all the pins. Call the function associated
+    to the gpio pin, if the callbacks are enabled.
+    '''
+
+    handler = _gpio_handlers.get(gpio)
+    if handler is not None:
+        handler(gpio, level, tick)
 
 
 def set_callbacks():
     '''
-    Enable the callback functions associated to the GPIO pins
-    and save the callback handlers
+    Enable the callback functions associated to the GPIO pins.
+    The pigpio callbacks are registered and their handlers saved only
+    the first time.
     '''
     global pi
-    global cb_counter_handler
-    global cb_dialer_handler
-    global cb_hangout_handler
+    global cb_handlers
+    global _gpio_handlers
 
-    cb_hangout_handler = pi.callback(pin_phone_hangout, pigpio.EITHER_EDGE, hangout)
-    cb_dialer_handler = pi.callback(pin_dial_detect, pigpio.EITHER_EDGE, dial_detect)
-    cb_counter_handler = pi.callback(pin_dial_counter, pigpio.EITHER_EDGE, pulse_count)
+    if not cb_handlers:
+        cb_handlers = [
+            pi.callback(pin_phone_hangout, pigpio.EITHER_EDGE, _gpio_dispatch),
+            pi.callback(pin_dial_detect, pigpio.EITHER_EDGE, _gpio_dispatch),
+            pi.callback(pin_dial_counter, pigpio.RISING_EDGE, _gpio_dispatch),
+        ]
 
-    # LED high when the rotary is accepting numbers
-    pi.write(pin_dial_counter_led, PI_HIGH)
+    cb_set_rotary()
 
 
-def release_callbacks():
+def cb_release_rotary():
     '''
-    Disable the callback functions
+    Disable the callback functions associated to the rotary dialer, only
+    the hangout callback remains enabled. The rotary edges are dropped.
     '''
     global pi
-    global cb_counter_handler
-    global cb_dialer_handler
-    global cb_hangout_handler
+    global _gpio_handlers
 
-    cb_hangout_handler.cancel()
-    cb_dialer_handler.cancel()
-    cb_counter_handler.cancel()
+    _gpio_handlers = {
+        pin_phone_hangout: hangout,
+    }
 
     # LED high when the rotary is accepting numbers
     pi.write(pin_dial_counter_led, PI_LOW)
 
 
-def cb_release_rotary():
+def cb_set_rotary():
     '''
-    Cancel the specific callback functions (disable the interrupt)
-    associated to the rotary dialer
+    Enable the callback functions associated to the rotary dialer
+    together with the hangout callback
     '''
     global pi
-    global cb_counter_handler
-    global cb_dialer_handler
+    global _gpio_handlers
 
-    cb_counter_handler.cancel()
-    cb_dialer_handler.cancel()
+    _gpio_handlers = {
+        pin_phone_hangout: hangout,
+        pin_dial_detect: dial_detect,
+        pin_dial_counter: pulse_count,
+    }
 
     # LED high when the rotary is accepting numbers
-    pi.write(pin_dial_counter_led, PI_LOW)
+    pi.write(pin_dial_counter_led, PI_HIGH)
 
 
-def cb_set_rotary():
+def release_callbacks():
     '''
-    Enable the specific callback functions (disable the interrupt)
-    associated to the rotary dialer
+    Disable the callback functions and cancel the pigpio callbacks
     '''
     global pi
-    global cb_counter_handler
-    global cb_dialer_handler
+    global cb_handlers
+    global _gpio_handlers
 
-    cb_dialer_handler = pi.callback(pin_dial_detect, pigpio.EITHER_EDGE, dial_detect)
-    cb_counter_handler = pi.callback(pin_dial_counter, pigpio.EITHER_EDGE, pulse_count)
+    _gpio_handlers = {}
+
+    for handler in cb_handlers:
+        handler.cancel()
+    cb_handlers = []
 
     # LED high when the rotary is accepting numbers
-    pi.write(pin_dial_counter_led, PI_HIGH)
+    pi.write(pin_dial_counter_led, PI_LOW)
 
 
-def cb_set_hangout():
+def _worker():
     '''
-    Set the hangout callback
+    Execute the commands queued by the callbacks. The commands are run outside
+    of the pigpio callback thread, one at a time and in the order they are queued.
+    A failing command is reported and does not stop the thread.
     '''
-    global pi
-    global cb_hangout_handler
 
-    cb_hangout_handler = pi.callback(pin_phone_hangout, pigpio.EITHER_EDGE, hangout)
+    while True:
+        command, argument = _cmd_q.get()
+        try:
+            command(argument)
+        except Exception as error:
+            debug_message('Command failed: ' + command.__name__, error, False)
+        finally:
+            _cmd_q.task_done()
 
 
 def debug_message(message, value = 0, message_only = True):
@@ -251,8 +401,8 @@ def debug_message(message, value = 0, message_only = True):
     Print the debug message if the debug flag is set
     '''
 
-    if(DEBUG == True):
-        if message_only is not True:
+    if DEBUG:
+        if not message_only:
             print(message, value)
         else:
             print(message)
@@ -266,7 +416,6 @@ def play_all_tracks():
     '''
     global track_position
     global is_playing
-    global music_path
     global tracks
 
     # Enable the amplifier and set the playing flag
@@ -278,7 +427,7 @@ def play_all_tracks():
 
     # Announce the initial message
     txt = text_messages[3] + ' ' + text_messages[2]
-    runCmd([TTS[0], TTS[1], txt])
+    tts_say(txt)
 
     # Play tracks until the playlist ends
     while track_position < tracks:
@@ -287,22 +436,21 @@ def play_all_tracks():
 
         # Announce the name of the track
         txt = text_messages[4] + ' ' + track_titles[track_position]
-        runCmd([TTS[0], TTS[1], txt])
+        tts_say(txt)
 
-        # Create the track file name and play it
-        txt = music_path + track_list[track_position] + '.mp3'
-        runCmd([PLAYER[0], txt])
+        # Play the track file
+        runCmd([PLAYER[0], track_paths[track_position]])
 
         # Update the track number
         track_position += 1
 
         # Stop the playing loop if the user hangout
-        if pi.read(pin_phone_hangout) is PI_LOW:
+        if pi.read(pin_phone_hangout) == PI_LOW:
             break;
 
     # Disabe the amplifier, if it has not yet disabled by the user
-    if is_playing is True:
-        ampli_on_off()
+    if is_playing:
+        ampli_on_off(wait=False)
         is_playing = False
 
 
@@ -322,7 +470,7 @@ def list_all_tracks():
 
     # Announce the initial message
     txt = text_messages[6] + ' ' + str(tracks) + ' ' + text_messages[7]
-    runCmd([TTS[0], TTS[1], txt])
+    tts_say(txt)
 
     counter = 0     # Playlist title counter
 
@@ -331,14 +479,14 @@ def list_all_tracks():
 
         # Announce the name of the track
         txt = ' ' + str(counter + 1) + ': ' + track_titles[counter] + ", "
-        runCmd([TTS[0], TTS[1], txt])
+        tts_say(txt)
 
         # Update the title number
         counter += 1
 
     # Disabe the amplifier, if it has not yet disabled by the user
-    if is_playing is True:
-        ampli_on_off()
+    if is_playing:
+        ampli_on_off(wait=False)
         is_playing = False
 
 
@@ -360,14 +508,14 @@ def say_help():
     while counter < help_strings:
 
         txt = help_messages[counter]
-        runCmd([TTS[0], TTS[1], txt])
+        tts_say(txt)
 
         # Update the title number
         counter += 1
 
     # Disabe the amplifier, if it is not yet disabled by the user
-    if is_playing is True:
-        ampli_on_off()
+    if is_playing:
+        ampli_on_off(wait=False)
         is_playing = False
 
 
@@ -379,7 +527,6 @@ def play_track():
     '''
     global track_position
     global is_playing
-    global music_path
     global tracks
 
     # Enable the amplifier and set the playing flag
@@ -388,11 +535,10 @@ def play_track():
 
     # Announce the name of the track
     txt = text_messages[4] + ' ' + track_titles[track_position]
-    runCmd([TTS[0], TTS[1], txt])
+    tts_say(txt)
 
-    # Create the track file name and play it
-    txt = music_path + track_list[track_position] + '.mp3'
-    runCmd([PLAYER[0], txt])
+    # Play the track file
+    runCmd([PLAYER[0], track_paths[track_position]])
 
     # Increment the number of the track and if the value is bigger
     # than  the max number of tracks it is reset.
@@ -401,8 +547,8 @@ def play_track():
         track_position = 0
 
     # Disabe the amplifier, if it has not yet disabled by the user
-    if is_playing is True:
-        ampli_on_off()
+    if is_playing:
+        ampli_on_off(wait=False)
         is_playing = False
 
 
@@ -417,24 +563,88 @@ def tts_message(msg):
     # Create the full text message
     tText = text_messages[msg]
 
-    return runCmd([TTS[0], TTS[1], tText])
+    return tts_say(tText)
+
+
+def start_tts():
+    '''
+    Start the text-to-speech command as a long-lived interactive shell
+    reading the sentences to speak from its stdin
+    '''
+    global _tts_proc
+
+    _tts_proc = subprocess.Popen(_TTS_ARGV,
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE,
+                                 )
+
+    # Wait for the shell to be ready
+    tts_wait()
+
+
+def tts_wait():
+    '''
+    Wait until the text-to-speech shell shows its prompt, that is until
+    it has finished speaking the last sentence.
+    :return: True when the prompt is shown, False if the process has ended
+    '''
+
+    tail = b''
+    while not tail.endswith(TTS_PROMPT):
+        data = os.read(_tts_proc.stderr.fileno(), 256)
+        if not data:
+            return False
+        tail = tail[-len(TTS_PROMPT):] + data
+
+    return True
+
+
+def tts_say(txt):
+    '''
+    Speak a sentence with the persistent text-to-speech process and wait for
+    it to be spoken. If the process has terminated it is restarted before
+    sending the sentence.
+    :param txt: The text to speak
+    :return: 0 or the tts process returncode if it has terminated
+    '''
+    global _tts_proc
+
+    returncode = _tts_proc.poll()
+    if returncode is not None:
+        start_tts()
+
+    # One sentence per line. Empty lines are ignored by the shell
+    # and would never get a prompt back
+    txt = txt.replace('\n', ' ').strip()
+    if txt == '':
+        return returncode or 0
+
+    try:
+        _tts_proc.stdin.write(txt.encode() + b'\n')
+        _tts_proc.stdin.flush()
+        if not tts_wait():
+            returncode = _tts_proc.wait()
+    except BrokenPipeError:
+        # The process died after the check, it is restarted by the next call
+        returncode = _tts_proc.wait()
+
+    return returncode or 0
 
 
 def runCmd(cmd, extra_info = False):
     '''
-    Execute a subprocess command managing the return value, stdout, stderr
-    and the return code (0 or not 0 if error occurred)
+    Execute a subprocess command discarding stdout and stderr and returning
+    the return code (0 or not 0 if error occurred)
     :param cmd: The bash command with the parameters
     :return: 0 or the error returncode
     '''
 
-    proc = subprocess.Popen(cmd,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            )
-    stdout, stderr = proc.communicate()
-
-    return proc.returncode # , stdout, stderr
+    return subprocess.run(cmd,
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL,
+                          check=False,
+                          ).returncode
 
 
 def get_weather():
@@ -453,7 +663,7 @@ def get_weather():
     ampli_on_off()
 
     # Announce the weather retrieval
-    runCmd([TTS[0], TTS[1], weather_airport])
+    tts_say(weather_airport)
 
     # Execute the weather command
     cmd = [WEATHER[0], weather_ICAO]
@@ -463,23 +673,16 @@ def get_weather():
                             stderr=subprocess.PIPE,
                             )
     stdout, stderr = proc.communicate()
-    # Divide the weather message in a list of single lines
-    # removing the newline characters
-    forecast = stdout.splitlines()
-
-    w = 4   # First useful line of the weather forecase
 
     # Say the forecast meaningful strings (starting from 4)
-    # Note that forecast is a list of bytes so every text line
-    # should be decoded to the corresponding ASCII string
-    while w < len(forecast):
-        text = forecast[w].decode('ascii')
-        runCmd([TTS[0], TTS[1], text])
-        w += 1
+    # Note that stdout is bytes so it is decoded once to the ASCII string
+    # then divided in single lines removing the newline characters
+    for text in stdout.decode('ascii', 'replace').splitlines()[4:]:
+        tts_say(text)
 
     # Disabe the amplifier, if it has not yet disabled by the user
-    if is_playing is True:
-        ampli_on_off()
+    if is_playing:
+        ampli_on_off(wait=False)
         is_playing = False
 
 
@@ -494,11 +697,11 @@ def wrong_command():
     ampli_on_off()
 
     # Announce the weather retrieval
-    runCmd([TTS[0], TTS[1], text_messages[8]])
+    tts_say(text_messages[8])
 
     # Disabe the amplifier, if it has not yet disabled by the user
-    if is_playing is True:
-        ampli_on_off()
+    if is_playing:
+        ampli_on_off(wait=False)
         is_playing = False
 
 
@@ -518,223 +721,202 @@ def play_tts_sentence(msg):
     tts_message(msg)
 
     # Disabe the amplifier, if it has not yet disabled by the user
-    if is_playing is True:
-        ampli_on_off()
+    if is_playing:
+        ampli_on_off(wait=False)
         is_playing = False
 
 
 def hangout(self, event, tick):
     '''
     Callback function.
-    Detect the hangon/hangoff switch of the pickup.
+    Detect the hangon/hangoff switch of the pickup and queue the
+    corresponding command with the level of the pin.
+    '''
+
+    _cmd_q.put((pickup_switch, event))
+
+
+def pickup_switch(status):
+    '''
+    Manage the hangon/hangoff switch of the pickup.
     The status of the switch will power the amplifier accordingly
-    when needed. When the function is called the LED is set accordingly
-    to the status of the pin
+    when needed. The LEDs are set accordingly to the status of the pin
+    A status equal to the last one processed is a bounce of the switch and
+    is ignored, as the amplifier power button is a toggle.
+    :param status: The level of the hangout pin when the switch changed
     '''
     global pi
-    global is_playing
+    global hangout_status
+
+    if status == hangout_status:
+        return
+    hangout_status = status
 
-    if pi.read(pin_phone_hangout) is PI_HIGH:
-        # Disable the interrupts until finished
-        release_callbacks()
+    # Disable the dialer until finished
+    cb_release_rotary()
+
+    if status == PI_HIGH:
         # Show the ready LED
         pi.write(pin_hangout_led, PI_HIGH)
         # Activation message
         play_tts_sentence(0)
-        # Enable the interrupts
-        set_callbacks()
+        # The rotary is accepting numbers
+        cb_set_rotary()
 
     else:
-        # Disable the interrupts until finished
-        release_callbacks()
         # End message
         play_tts_sentence(1)
-        # Disable the ready LED
-        pi.write(pin_hangout_led, PI_LOW)
-        # Enable only the hangout interrupt
+        # Disable the ready LED together with the others
         reinit()
-        cb_set_hangout()
 
 
-def dial_detect(self, event, tick):
+def dial_detect(self, event, tick, st=_state, high=PI_HIGH, low=PI_LOW):
     '''
     Manage the dialer pulses to encode the dialed number
     then the number is queued to the string collecting the numbers
-    processed by the main program.
+    and the string is queued to be checked by the worker thread.
     The dialer works only if the pick up is open.
+    The dialer status and the pin levels are bound as default arguments
+    so they are accessed as locals.
     '''
-    global dialer_status
-    global pulses
-    global max_numbers
-    global dialed_number
     global pi
 
-    if pi.read(pin_phone_hangout) is PI_HIGH:
-        # Detect if the user started dialing a number
-        dialer_status = pi.read(pin_dial_detect)
+    if pi.read(pin_phone_hangout) == high:
+        # Detect if the user started dialing a number from the level
+        # of the edge reported by pigpio
+        st.dialer_status = event
 
         # Check if a number is to be dialed
-        if dialer_status is PI_HIGH:
+        if st.dialer_status == high:
             # Reset the pulses counter
-            pulses = 0
-            pi.write(pin_dialer_led, PI_HIGH)
+            st.pulses = 0
+            pi.write(pin_dialer_led, high)
 
         # Check if the dialed number has reached the maximum length
         # to reset the number and start a new queue
-        if len(dialed_number) >= max_numbers:
-            dialed_number = ''      # Reset the number sequence
+        if len(st.dialed_number) >= max_numbers:
+            st.dialed_number = ''      # Reset the number sequence
         else:
             # Queue the dialed number
-            if pulses is not 0:
+            pulses = st.pulses
+            if pulses != 0:
                 # When the cipher 0 is dialed the rotary wheel
                 # emit 10 pulses
-                if pulses == 20:
+                if pulses == 10:
                     pulses = 0
 
-                dialed_number = dialed_number + str(int(pulses / 2))
+                number = st.dialed_number + str(pulses)
+                st.dialed_number = number
+                # Restart to initial conditions: reset the number sequence
+                # here, only the LEDs are reset by the command
+                if number == reset_number:
+                    st.dialed_number = ''
                 # Check if the user has dialed a valid number associated to
                 # a command.
-                check_number()
+                _cmd_q.put((check_number, number))
 
-        pi.write(pin_dialer_led, PI_LOW)
+        pi.write(pin_dialer_led, low)
 
 
-def check_number():
+def check_number(number):
     '''
-    Check if the current number corresponds to a valid command.
+    Check if the number corresponds to a valid command.
+    Nothing is executed if the phone has been hung up in the meantime.
+    :param number: The dialed number string
     '''
-    global dialed_number
     global track_position
-    global pi
 
-    debug_message(str(dialed_number))
+    debug_message(number)
+
+    if hangout_status == PI_LOW:
+        return
 
     # Numeric commands and related functions
-    if dialed_number is not '':
-        if int(dialed_number) == 666:
-            # Restart the appplication to initial conditions
-            dialed_number = ''
-            reinit()
-
-        # Play the next track
-        elif int(dialed_number) == 321:
-            # Disable the interrupts until finished
-            release_callbacks()
-            # Start playing the next track
-            play_track()
-            # Enable the interrupts
-            cb_set_hangout()
-            # If the hangout is still active, enable the dialer too
-            if pi.read(pin_hangout_led) is PI_HIGH:
-                cb_set_rotary()
-
-        # Play all tracks in sequence
-        elif int(dialed_number) == 123:
-            # Disable the interrupts until finished
-            release_callbacks()
-            # Play the entire playlist
-            play_all_tracks()
-            # Enable the interrupts
-            cb_set_hangout()
-            # If the hangout is still active, enable the dialer too
-            if pi.read(pin_hangout_led) is PI_HIGH:
-                cb_set_rotary()
-
-        # Tell the playlist titles
-        elif int(dialed_number) == 124:
-            # Disable the interrupts until finished
-            release_callbacks()
-            # Tell the playlist titles
-            list_all_tracks()
-            # Enable the interrupts
-            cb_set_hangout()
-            # If the hangout is still active, enable the dialer too
-            if pi.read(pin_hangout_led) is PI_HIGH:
-                cb_set_rotary()
+    if number != '':
+        code = int(number)
+        command = _COMMANDS.get(code)
+
+        if command is not None:
+            command()
 
         # Play the desired track
-        elif (int(dialed_number) <= tracks + 400) and (int(dialed_number) > 400):
-            track_position = int(dialed_number) - 401
-            # Disable the interrupts until finished
-            release_callbacks()
-            # Start playing the next track
-            play_track()
-            # Enable the interrupts
-            cb_set_hangout()
-            # If the hangout is still active, enable the dialer too
-            if pi.read(pin_hangout_led) is PI_HIGH:
-                cb_set_rotary()
-
-        # Tell the help notes
-        elif int(dialed_number) == 111:
-            # Disable the interrupts until finished
-            release_callbacks()
-            # Tell the help messages
-            say_help()
-            # Enable the interrupts
-            cb_set_hangout()
-            # If the hangout is still active, enable the dialer too
-            if pi.read(pin_hangout_led) is PI_HIGH:
-                cb_set_rotary()
-
-        elif int(dialed_number) == 999:
-            # Reboot the system
-            runCmd([REBOOT[0], REBOOT[1], REBOOT[2]])
-
-        # Tell the weather
-        elif int(dialed_number) == 100:
-            # Disable the interrupts until finished
-            release_callbacks()
-            # Retrieve and say the weather message
-            get_weather()
-            # Enable the interrupts
-            cb_set_hangout()
-            # If the hangout is still active, enable the dialer too
-            if pi.read(pin_hangout_led) is PI_HIGH:
-                cb_set_rotary()
-
-        elif int(dialed_number) == 999:
-            # Reboot the system
-            runCmd([REBOOT[0], REBOOT[1], REBOOT[2]])
+        elif 400 < code <= tracks + 400:
+            track_position = code - 401
+            _play_track_guarded()
 
         # else:
         #     # Wrong command message
         #     wrong_command()
 
 
+def reset_leds():
+    '''
+    Switch off all the LEDs
+    '''
+    global pi
+
+    pi.clear_bank_1(_LED_MASK)
+
+
 def reinit():
     '''
-    Restart the appplication to initial conditions
+    Restart the appplication to initial conditions.
+    Only the runtime status is reset, the json configuration is not reloaded.
     '''
     global pi
-    global dialed_number
 
-    # Reset the LEDs
-    pi.write(pin_dial_counter_led, PI_LOW)
-    pi.write(pin_hangout_led, PI_LOW)
-    pi.write(pin_dialer_led, PI_LOW)
+    reset_leds()
     # Reset the dialed number
-    dialed_number = ''
+    _state.dialed_number = ''
     track_position = 0
     is_playing = True
 
 
-def pulse_count(self, event, tick):
+def pulse_count(self, event, tick, st=_state, high=PI_HIGH):
     '''
     Count the pulses when the user dials a number. Only the HIGH values are
     considered as pulses and the counter increase the number only when the
     dialer_status value is HIGH.
 
-    Note that the number of pulses is doubled as the interrupt
-    read both the transitions to and from high.
+    Only the rising edges are notified, the contact bounces are already
+    removed by the glitch filter set on the pin.
     '''
-    global pulses
 
-    if dialer_status is PI_HIGH:
-        pulses += 1
+    if st.dialer_status == high:
+        st.pulses += 1
+
+
+def create_ampli_wave():
+    '''
+    Create the waveform simulating the amplifier buttons: the power button is
+    pressed for 5 seconds, then after 2 seconds the mode button is pressed for
+    half a second. The timing is generated by the pigpio daemon via DMA.
+    '''
+    global pi
+    global _ampli_wave
+
+    pi.wave_add_generic([
+        # Power on/off the ampli
+        pigpio.pulse(_AMPLI_POWER_MASK, 0, 5000000),
+        pigpio.pulse(0, _AMPLI_POWER_MASK, 2000000),
+        # Set mode to direct plug audio
+        pigpio.pulse(_AMPLI_MODE_MASK, 0, 500000),
+        pigpio.pulse(0, _AMPLI_MODE_MASK, 0),
+    ])
+    _ampli_wave = pi.wave_create()
 
 
-def ampli_on_off():
+def ampli_wait():
+    '''
+    Wait until the amplifier buttons waveform has been completely sent
+    '''
+    global pi
+
+    while pi.wave_tx_busy():
+        time.sleep(0.05)
+
+
+def ampli_on_off(wait=True):
     '''
     Amplifier buttons simulator. Simulate the amplifier buttons for power on and
     setting the input mode to the cable input.
@@ -742,27 +924,94 @@ def ampli_on_off():
     power on/off button really powers it on or off. If the logic become inverted,
     there is a specific dial code that press the power button, independently by
     the status and the state of the pick-up switch status.
+    :param wait: If True return when the buttons sequence has ended, as the
+    amplifier should be ready before playing audio. If False return as soon
+    as the sequence is started
     '''
 
     global ampli_status
     global pi
 
-    # Power on/off the ampli
-    pi.write(pin_ampli_power, PI_HIGH)
-    time.sleep(5)
-    pi.write(pin_ampli_power, PI_LOW)
-    time.sleep(2)
-    # Set mode to direct plug audio
-    pi.write(pin_ampli_mode, PI_HIGH)
-    time.sleep(0.5)
-    pi.write(pin_ampli_mode, PI_LOW)
+    # A new waveform would stop the one in progress
+    ampli_wait()
+    pi.wave_send_once(_ampli_wave)
+
+    if wait:
+        ampli_wait()
+
     ampli_status = False
 
 
+def reboot():
+    '''
+    Cold reset of the system
+    '''
+
+    runCmd(REBOOT)
+
+
+def _run_guarded(command):
+    '''
+    Wrap a dial command so the dialer callbacks are disabled until it has
+    finished: the numbers dialed in the meantime are dropped. Then, if the
+    hangout is still active, the dialer callbacks are enabled again.
+    :param command: The function executing the command
+    :return: The wrapped function
+    '''
+
+    def guarded():
+        # Disable the dialer until finished
+        cb_release_rotary()
+        command()
+        # If the hangout is still active, enable the dialer again
+        if pi.read(pin_hangout_led) == PI_HIGH:
+            cb_set_rotary()
+
+    return guarded
+
+
+# ------------------------------------------------------------------------------
+# Dial codes and the corresponding commands. The play desired track codes
+# (401 to 400 + number of tracks) depend on the playlist and are checked
+# separately by check_number()
+# ------------------------------------------------------------------------------
+_play_track_guarded = _run_guarded(play_track)
+
+_COMMANDS = {
+    666: reset_leds,                        # Restart to initial conditions
+    321: _play_track_guarded,               # Play the next track
+    123: _run_guarded(play_all_tracks),     # Play all tracks in sequence
+    124: _run_guarded(list_all_tracks),     # Tell the playlist titles
+    111: _run_guarded(say_help),            # Tell the help notes
+    100: _run_guarded(get_weather),         # Tell the weather
+    999: reboot,                            # Reboot the system
+}
+
+
+def shutdown(signum, frame):
+    '''
+    Signal handler. Release the callbacks and the pigpio daemon connection
+    before exiting the application.
+    '''
+    global pi
+
+    release_callbacks()
+    _tts_proc.stdin.close()
+    # Let a power off sequence in progress end, then free the waveform
+    ampli_wait()
+    pi.wave_delete(_ampli_wave)
+    pi.stop()
+    sys.exit(0)
+
+
 if __name__ == '__main__':
     # Main application
+    _load_config()
     initGPIO()
-    
-    # looping infinitely
-    while True:
-        pass
+
+    # Clean exit on kill or Ctrl-C
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    # Sleep until a signal is received, the callbacks do the job
+    signal.pause()